@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+AstrBot 风格学习插件测试夹具
+"""
+
+import sys
+import os
+
+import pytest
+
+# 添加插件目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from plugin import StyleLearningPlugin
+
+@pytest.fixture(scope="session")
+def plugin(tmp_path_factory):
+    """整个测试会话共用一个插件实例（数据库位于临时目录，不改动 data/learning_data.db），全部测试结束后卸载"""
+    plugin = StyleLearningPlugin(data_path=str(tmp_path_factory.mktemp("data")))
+    print("插件初始化完成")
+    
+    yield plugin
+    
+    # 卸载插件
+    plugin.on_plugin_unload()
@@ -3,47 +3,292 @@ import time
 import re
 import sqlite3
 import threading
+import contextlib
 import datetime
-import hashlib
+import logging
+import logging.handlers
 import os
+import collections
+import mmap
+import operator
+import queue
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Any
 
+logger = logging.getLogger("astrabot_plugin_learning")
+
+# 日志文件的记录格式；单个日志文件的大小上限与保留的轮转文件数
+_LOG_FORMAT = "%(asctime)s [%(name)s] %(levelname)s: %(message)s"
+_LOG_MAX_BYTES = 5 * 1024 * 1024
+_LOG_BACKUP_COUNT = 3
+
+# 导入聊天记录时每处理多少行输出一次进度
+_IMPORT_PROGRESS_INTERVAL = 1000
+
+# 每个写事务最多写入的消息数（写入队列落库与导入聊天记录共用）
+_WRITE_BATCH_SIZE = 500
+
+# 消息写入队列：积压达到阈值或间隔到期时由后台线程批量落库
+_FLUSH_THRESHOLD = 100
+_FLUSH_INTERVAL = 1.0
+
+# 导入前统计行数时，每次从内存映射中取出计数的字节数
+_LINE_COUNT_CHUNK = 1 << 20
+# 导入时读取聊天记录文件的缓冲区大小
+_IMPORT_READ_BUFFER = 1 << 20
+
+# 导入时解析线程与写入线程之间最多积压的批次数
+_IMPORT_QUEUE_SIZE = 4
+
+# 数据库结构版本（记录在 PRAGMA user_version 中）
+_SCHEMA_VERSION = 1
+
+# 学习任务线程池大小（保持较少的写入者，避免 SQLite 写锁竞争）
+_LEARNING_WORKERS = 2
+
+# 插件卸载时等待学习任务与后台写入线程结束的总时长（秒）
+_UNLOAD_TIMEOUT = 5
+
+# 批量查询风格特征时每条 SQL 的用户数（低于 SQLite 默认的 999 个参数上限）
+_STYLE_QUERY_CHUNK = 900
+
+# 去重缓存：消息在 1 小时内重复出现才计数
+_DEDUP_TTL = 3600
+
+# 实时消息去重缓存的分片数：每个分片有独立的锁，按消息哈希选择分片
+_CACHE_SHARDS = 16
+
+# 导入去重缓存的容量上限（导入量远大于实时消息缓存，单独设置上限）
+_IMPORT_CACHE_SIZE = 200000
+
+# 有效消息必须包含的字段（校验时用一次集合比较代替逐个字段判断）
+_REQUIRED_MESSAGE_FIELDS = frozenset(("user_id", "user_name", "content", "send_time", "session_id"))
+
+# 链接模式：与配置中的敏感词合并为一个拒绝正则（见 _compile_filters）
+_URL_PATTERN = r'https?://\S+'
+
+# 预编译的正则表达式（避免每条消息重复编译）
+_EMOJI_RE = re.compile(r'[\U0001F600-\U0001F6FF]')
+_SENT_SPLIT_RE = re.compile(r'[。！？!?.]')
+_GREETING_RE = re.compile(r'(你好|您好|早上好|晚上好|hello|hi)', re.IGNORECASE)
+_HELP_RE = re.compile(r'(帮我|求助|需要|怎么|如何)')
+_THANKS_RE = re.compile(r'(谢谢|感谢|谢了|麻烦了)')
+
+# 聊天记录导出文件中的分隔线，导入时直接跳过：只由重复符号组成（如 "----------"），
+# 或中间只有日期时间（如 "====== 2024-01-01 ======"）；"*** 重要通知 ***" 这类带文字的消息不算
+_SEPARATOR_RE = re.compile(
+    r'([=\-~*#_—])\1{2,}'
+    r'(?:\s*\d{4}[-/.年]\d{1,2}[-/.月]\d{1,2}日?(?:\s+\d{1,2}:\d{2}(?::\d{2})?)?\s*\1{3,})?'
+)
+
+# 时间戳各字段直接作为分组捕获，解析时无需再调用 strptime
+_TIMESTAMP_RE = re.compile(r'^\[?(\d{4})[-/](\d{2})[-/](\d{2})\s(\d{2}):(\d{2}):(\d{2})\]?')
+
+# 数据库中 JSON 字段的编码器：紧凑分隔符、中文不转义（复用同一实例，避免每次调用重新构造）
+_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+# 风格分析词表，每个类别编译为一个多词匹配的正则（一次扫描即可判断是否命中）
+_LEXICON = {
+    "formal": ["您好", "请问", "谢谢", "对不起", "请"],
+    "informal": ["哈哈", "嘿嘿", "哦哦", "嗯", "哎"],
+    "positive": ["好", "开心", "快乐", "喜欢", "不错", "棒", "优秀"],
+    "negative": ["不好", "难过", "伤心", "讨厌", "糟糕", "差", "失望"]
+}
+_LEXICON_PATTERNS = [
+    (category, re.compile("|".join(map(re.escape, words))))
+    for category, words in _LEXICON.items()
+]
+
+def _deep_merge(base: Dict, override: Dict) -> Dict:
+    """将 override 递归合并到 base 中（嵌套字典逐层合并，其余值直接覆盖）"""
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _deep_merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+def _dump_config(config: Dict) -> str:
+    """序列化配置（加载时的变更比较与保存共用同一格式）"""
+    return json.dumps(config, ensure_ascii=False, indent=2)
+
+class _TTLCache:
+    """带过期时间和容量上限的缓存（按插入顺序淘汰，调用方负责加锁）"""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # 键 -> (插入时间, 值)，按插入时间排序，只需从头部淘汰
+        self._data = collections.OrderedDict()
+    
+    def expire(self, now: float):
+        """淘汰过期的缓存项"""
+        data = self._data
+        while data and now - next(iter(data.values()))[0] >= self.ttl:
+            data.popitem(last=False)
+    
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        return default if item is None else item[1]
+    
+    def set(self, key, value, now: float):
+        """写入缓存项（已存在的键保留原插入时间），超出容量时淘汰最早的项"""
+        data = self._data
+        item = data.get(key)
+        if item is not None:
+            data[key] = (item[0], value)
+            return
+        
+        data[key] = (now, value)
+        while len(data) > self.maxsize:
+            data.popitem(last=False)
+    
+    def discard(self, key):
+        self._data.pop(key, None)
+    
+    def clear(self):
+        self._data.clear()
+    
+    def __contains__(self, key) -> bool:
+        return key in self._data
+    
+    def __len__(self) -> int:
+        return len(self._data)
+
+class _DedupShard:
+    """实时消息去重缓存的一个分片：独立的锁和精确计数缓存"""
+    
+    def __init__(self, maxsize: int):
+        self.lock = threading.Lock()
+        self.cache = _TTLCache(maxsize, _DEDUP_TTL)
+
+class _SharedLogFile:
+    """进程内共享的日志文件：模块 logger 是进程级的，所有插件实例共用一个队列处理器和后台写入线程
+    
+    按引用计数管理，最后一个使用者释放时停止；避免每个实例各自挂载处理器导致同一条日志重复写入。
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+        self.path = None
+        self.handler = None
+        self.listener = None
+    
+    def acquire(self, path: str):
+        """登记一个使用者；日志文件路径变化时（如重载配置）改为写入新文件"""
+        with self.lock:
+            self.users += 1
+            if path != self.path:
+                self._stop()
+                self._start(path)
+    
+    def release(self):
+        """注销一个使用者"""
+        with self.lock:
+            self.users -= 1
+            if self.users == 0:
+                self._stop()
+    
+    def _start(self, path: str):
+        """经队列把日志交给后台线程写入按大小轮转的日志文件"""
+        file_handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=_LOG_MAX_BYTES, backupCount=_LOG_BACKUP_COUNT,
+            encoding='utf-8', delay=True
+        )
+        file_handler.setFormatter(logging.Formatter(_LOG_FORMAT))
+        
+        log_queue = queue.SimpleQueue()
+        self.handler = logging.handlers.QueueHandler(log_queue)
+        self.listener = logging.handlers.QueueListener(log_queue, file_handler)
+        self.listener.start()
+        logger.addHandler(self.handler)
+        self.path = path
+    
+    def _stop(self):
+        """停止后台线程（会先写完队列中剩余的日志）并关闭日志文件"""
+        if self.listener is None:
+            return
+        
+        logger.removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+        
+        self.handler = None
+        self.listener = None
+        self.path = None
+
+_LOG_FILE = _SharedLogFile()
+
 class StyleLearningPlugin:
     """AstrBot 风格学习插件 - 学习真人说话方式和风格"""
     
-    def __init__(self):
+    def __init__(self, data_path: Optional[str] = None):
         self.name = "astrabot_plugin_learning"
         self.version = "1.0.0"
         self.author = "AstrBot"
         self.description = "学习真人说话风格的插件，支持多维度风格分析和应用"
         
-        # 配置文件路径
+        # 配置文件路径（数据目录默认为插件目录下的 data，可通过 data_path 指定，如测试时使用临时目录）
         self.config_path = os.path.join(os.path.dirname(__file__), "config.json")
-        self.data_path = os.path.join(os.path.dirname(__file__), "data")
+        self.data_path = data_path or os.path.join(os.path.dirname(__file__), "data")
         self.db_path = os.path.join(self.data_path, "learning_data.db")
         
         # 加载配置
         self.config = self._load_config()
+        self._apply_log_level()
+        self._log_file_acquired = False
+        self._start_log_listener()
+        self._compile_filters()
+        
+        # 数据库连接（每个线程复用一个长连接）
+        self._tls = threading.local()
+        self._conn_generation = 0
         
         # 初始化数据库
         self._init_database()
         
-        # 消息缓存
-        self.message_cache = {}
-        self.cache_lock = threading.Lock()
+        # 消息缓存（1小时过期，超出容量时淘汰最早的项），按消息哈希分片以减少锁竞争
+        self._cache_shards = [_DedupShard(self._shard_cache_size()) for _ in range(_CACHE_SHARDS)]
+        # 导入聊天记录使用独立的去重缓存，避免大批量导入挤掉实时消息的缓存项
+        self.import_cache = _TTLCache(_IMPORT_CACHE_SIZE, _DEDUP_TTL)
+        self.import_cache_lock = threading.Lock()
         
-        # 学习任务管理
+        # 学习任务管理（_active_tasks 为已提交且尚未结束的任务数）
         self.learning_tasks = {}
         self.tasks_lock = threading.Lock()
+        self._active_tasks = 0
         
-        # 风格特征存储
+        # 风格特征存储（写时复制：写入方持有 style_lock 构建新字典后整体替换，读取方直接读取引用无需加锁）
         self.style_features = {}
         self.style_lock = threading.Lock()
         
         # 异步任务线程池
-        self.task_pool = []
+        self.executor = None
+        self._start_executor()
+        
+        # 统计计数增量（由后台线程定期写入数据库）
+        self._stat_counters = collections.defaultdict(int)
+        self.stats_lock = threading.Lock()
+        
+        # 用户有效消息计数（首次访问时从数据库加载）
+        # _bulk_write_seq 为已提交的批量写入序号，_counts_write_seq 为加载计数时已包含的最大序号
+        self._user_valid_counts = None
+        self._counts_write_seq = 0
+        self.counts_lock = threading.Lock()
         
-        print(f"[{self.name}] 插件初始化完成")
+        # 消息写入队列（_flush_lock 同时串行化批量写入与计数加载，可重入以便加载时先写入队列）
+        self._pending_messages = collections.deque()
+        self._flush_lock = threading.RLock()
+        self._bulk_write_seq = 0
+        self._flush_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._flush_thread = None
+        self._start_flush_thread()
+        
+        logger.info("插件初始化完成")
     
     def _load_config(self) -> Dict:
         """加载配置文件"""
@@ -80,35 +325,130 @@ class StyleLearningPlugin:
             }
         }
         
+        current_text = None
         if os.path.exists(self.config_path):
             try:
                 with open(self.config_path, 'r', encoding='utf-8') as f:
-                    user_config = json.load(f)
-                    # 合并配置
-                    for key, value in user_config.items():
-                        if key in default_config:
-                            default_config[key].update(value)
-                        else:
-                            default_config[key] = value
-            except Exception as e:
-                print(f"[{self.name}] 加载配置失败: {e}")
-        
-        # 保存配置
-        self._save_config(default_config)
+                    current_text = f.read()
+                # 合并配置
+                _deep_merge(default_config, json.loads(current_text))
+            except Exception:
+                logger.exception("加载配置失败")
+        
+        # 配置有变化（如补充了新的默认项）时才保存
+        if _dump_config(default_config) != current_text:
+            self._save_config(default_config)
         return default_config
     
+    def _apply_log_level(self):
+        """按配置设置插件日志级别（无效的级别名保持默认）"""
+        level = logging.getLevelName(str(self.config["logging"]["level"]).upper())
+        if isinstance(level, int):
+            logger.setLevel(level)
+    
+    def _start_log_listener(self):
+        """配置了日志文件时，经队列把日志交给后台线程写入文件，避免在调用线程中同步写盘"""
+        if self._log_file_acquired:
+            return
+        
+        log_file = self.config["logging"].get("log_file")
+        if not log_file:
+            return
+        
+        if not os.path.isabs(log_file):
+            log_file = os.path.join(os.path.dirname(__file__), log_file)
+        
+        _LOG_FILE.acquire(log_file)
+        self._log_file_acquired = True
+    
+    def _stop_log_listener(self):
+        """释放日志文件（没有其他插件实例使用时停止后台线程并关闭文件）"""
+        if not self._log_file_acquired:
+            return
+        
+        _LOG_FILE.release()
+        self._log_file_acquired = False
+    
+    def _compile_filters(self):
+        """根据配置预先构建消息过滤用的前缀元组、用户集合和敏感词正则"""
+        filter_config = self.config["message_filter"]
+        self._command_prefixes = tuple(filter_config["command_prefix"])
+        self._blacklist_users = frozenset(filter_config["blacklist_users"])
+        self._whitelist_users = frozenset(filter_config["whitelist_users"])
+        
+        # 链接和所有敏感词合并为一个正则，一次扫描即可判断是否需要拒绝
+        sensitive_words = [word for word in filter_config["sensitive_words"] if word]
+        self._reject_re = re.compile("|".join([_URL_PATTERN, *map(re.escape, sensitive_words)]), re.ASCII)
+        self._has_sensitive_words = bool(sensitive_words)
+    
     def _save_config(self, config: Dict):
         """保存配置文件"""
         os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
         with open(self.config_path, 'w', encoding='utf-8') as f:
-            json.dump(config, f, ensure_ascii=False, indent=2)
+            f.write(_dump_config(config))
+    
+    def _connect(self) -> sqlite3.Connection:
+        """获取当前线程的数据库连接（首次访问时创建并应用连接级 PRAGMA）"""
+        conn = getattr(self._tls, "conn", None)
+        if conn is not None and self._tls.generation == self._conn_generation:
+            return conn
+        
+        if conn is not None:
+            # 连接已被 _close_connections 作废，重新建立
+            conn.close()
+        
+        # isolation_level=None：单条写入自动提交，多条写入通过 _transaction 显式开启事务
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        # 以下 PRAGMA 只对当前连接生效（journal_mode 已在初始化时持久化为 WAL）
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+        conn.execute("PRAGMA busy_timeout=5000")
+        
+        self._tls.conn = conn
+        self._tls.generation = self._conn_generation
+        return conn
+    
+    @contextlib.contextmanager
+    def _transaction(self):
+        """在当前线程的连接上执行一个显式写事务
+        
+        使用 BEGIN IMMEDIATE 在事务开始时即获取写锁：多个线程同时写入时，
+        等待由 busy_timeout 处理，避免读锁升级为写锁时直接返回 SQLITE_BUSY。
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            # SQLITE_FULL、IOERR 等错误时 SQLite 已自动回滚，此时再执行 ROLLBACK 会掩盖原始错误
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        else:
+            try:
+                conn.execute("COMMIT")
+            except BaseException:
+                # 提交失败（如等待写锁超时）时回滚，避免缓存的连接停留在未结束的事务中，
+                # 导致该线程之后的 BEGIN 全部失败
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+    
+    def _close_connections(self):
+        """关闭当前线程的连接，并使其他线程缓存的连接失效"""
+        self._conn_generation += 1
+        conn = getattr(self._tls, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._tls.conn = None
     
     def _init_database(self):
         """初始化数据库"""
         os.makedirs(self.data_path, exist_ok=True)
         
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             # 创建消息表
@@ -128,17 +468,7 @@ class StyleLearningPlugin:
             ''')
             
             # 创建风格特征表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS style_features (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT NOT NULL,
-                    feature_name TEXT NOT NULL,
-                    feature_value TEXT NOT NULL,
-                    confidence REAL NOT NULL,
-                    update_time INTEGER NOT NULL,
-                    UNIQUE(user_id, feature_name)
-                )
-            ''')
+            self._create_style_features_table(cursor)
             
             # 创建会话上下文表
             cursor.execute('''
@@ -162,11 +492,63 @@ class StyleLearningPlugin:
                 )
             ''')
             
-            conn.commit()
-            conn.close()
-            print(f"[{self.name}] 数据库初始化完成")
-        except Exception as e:
-            print(f"[{self.name}] 数据库初始化失败: {e}")
+            # 升级旧版本的数据库结构
+            self._migrate_database(conn)
+            
+            # 创建索引（匹配按用户查询有效消息并按时间倒序取最新 N 条的查询）
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_user_valid_time
+                ON messages (user_id, is_valid, send_time DESC)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_style_user
+                ON style_features (user_id)
+            ''')
+            
+            # 启用 WAL 模式：减少每次提交的 fsync，并允许读写并发
+            conn.execute("PRAGMA journal_mode=WAL")
+            logger.info("数据库初始化完成")
+        except Exception:
+            logger.exception("数据库初始化失败")
+    
+    def _create_style_features_table(self, cursor: sqlite3.Cursor, table_name: str = "style_features"):
+        """创建风格特征表（数值特征存为 REAL，场景模式等文本特征存入 feature_text）"""
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                feature_name TEXT NOT NULL,
+                feature_value REAL,
+                feature_text TEXT,
+                confidence REAL NOT NULL,
+                update_time INTEGER NOT NULL,
+                UNIQUE(user_id, feature_name)
+            )
+        ''')
+    
+    def _migrate_database(self, conn: sqlite3.Connection):
+        """根据 user_version 升级数据库结构"""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= _SCHEMA_VERSION:
+            return
+        
+        # 版本 0 -> 1：style_features.feature_value 由 TEXT 改为 REAL
+        columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(style_features)")}
+        if columns.get("feature_value", "").upper() == "TEXT":
+            with self._transaction():
+                cursor = conn.cursor()
+                self._create_style_features_table(cursor, "style_features_new")
+                cursor.execute('''
+                    INSERT INTO style_features_new
+                    (id, user_id, feature_name, feature_value, confidence, update_time)
+                    SELECT id, user_id, feature_name, CAST(feature_value AS REAL), confidence, update_time
+                    FROM style_features
+                ''')
+                cursor.execute("DROP TABLE style_features")
+                cursor.execute("ALTER TABLE style_features_new RENAME TO style_features")
+            logger.info("风格特征表已升级为数值存储")
+        
+        conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
     
     # 一、基础：有效消息收集与过滤模块
     def handle_message(self, message: Dict):
@@ -194,7 +576,10 @@ class StyleLearningPlugin:
     
     def on_enable(self):
         """插件启用时调用 - AstrBot标准接口"""
-        print(f"[{self.name}] 插件已启用")
+        self._start_log_listener()
+        self._start_executor()
+        self._start_flush_thread()
+        logger.info("插件已启用")
         return True
     
     def on_disable(self):
@@ -206,16 +591,20 @@ class StyleLearningPlugin:
         """插件重载时调用 - AstrBot标准接口"""
         # 重新加载配置
         self.config = self._load_config()
-        print(f"[{self.name}] 插件已重载")
+        self._apply_log_level()
+        self._stop_log_listener()
+        self._start_log_listener()
+        self._compile_filters()
+        shard_size = self._shard_cache_size()
+        for shard in self._cache_shards:
+            with shard.lock:
+                shard.cache.maxsize = shard_size
+        logger.info("插件已重载")
         return True
     
     def _is_valid_message_format(self, message: Dict) -> bool:
         """验证消息格式是否有效"""
-        required_fields = ["user_id", "user_name", "content", "send_time", "session_id"]
-        for field in required_fields:
-            if field not in message:
-                return False
-        return True
+        return message.keys() >= _REQUIRED_MESSAGE_FIELDS
     
     def _extract_message_metadata(self, message: Dict) -> Dict:
         """提取消息核心元数据"""
@@ -235,31 +624,25 @@ class StyleLearningPlugin:
         user_id = message["user_id"]
         
         # 命令过滤
-        for prefix in self.config["message_filter"]["command_prefix"]:
-            if content.startswith(prefix):
-                return False
+        if content.startswith(self._command_prefixes):
+            return False
         
         # 长度过滤
         if len(content) < self.config["message_filter"]["min_message_length"]:
             return False
         
         # 用户过滤
-        if user_id in self.config["message_filter"]["blacklist_users"]:
+        if user_id in self._blacklist_users:
             return False
         
-        if self.config["message_filter"]["whitelist_users"] and \
-           user_id not in self.config["message_filter"]["whitelist_users"]:
+        if self._whitelist_users and user_id not in self._whitelist_users:
             return False
         
-        # 内容过滤（广告、链接、敏感信息）
-        if re.search(r'(http|https)://\S+', content):
+        # 内容过滤（广告、链接、敏感词）
+        # 未配置敏感词时，不含 "://" 的消息不可能命中链接模式，可跳过正则扫描
+        if (self._has_sensitive_words or "://" in content) and self._reject_re.search(content):
             return False
         
-        # 敏感词过滤
-        for word in self.config["message_filter"]["sensitive_words"]:
-            if word in content:
-                return False
-        
         return True
     
     def _is_duplicate_message(self, message: Dict) -> bool:
@@ -267,59 +650,147 @@ class StyleLearningPlugin:
         content = message["content"]
         session_id = message["session_id"]
         
-        # 生成消息哈希
-        message_hash = hashlib.md5(content.encode('utf-8')).hexdigest()
+        # 生成消息哈希（仅用作进程内去重键，无需加密哈希）
+        message_hash = hash(content)
+        cache_key = (session_id, message_hash)
+        
+        # 同一内容总落在同一分片，只需持有该分片的锁
+        shard = self._cache_shards[message_hash % _CACHE_SHARDS]
         
-        with self.cache_lock:
+        with shard.lock:
             # 清理过期缓存
             current_time = time.time()
-            self.message_cache = {
-                k: v for k, v in self.message_cache.items()
-                if current_time - v["timestamp"] < 3600  # 1小时过期
-            }
+            shard.cache.expire(current_time)
             
-            # 检查重复
-            cache_key = f"{session_id}:{message_hash}"
-            if cache_key in self.message_cache:
-                self.message_cache[cache_key]["count"] += 1
-                if self.message_cache[cache_key]["count"] > self.config["message_filter"]["max_duplicate_count"]:
-                    return True
-            else:
-                self.message_cache[cache_key] = {
-                    "timestamp": current_time,
-                    "count": 1
-                }
+            # 检查重复（计数从首次出现起算，1 小时后随缓存项过期）
+            count = shard.cache.get(cache_key, 0) + 1
+            shard.cache.set(cache_key, count, current_time)
+            
+            if count > self.config["message_filter"]["max_duplicate_count"]:
+                return True
         
         return False
     
+    def _shard_cache_size(self) -> int:
+        """每个去重缓存分片的容量（总容量按分片数均分，向上取整）"""
+        return max(1, -(-self.config["learning"]["max_cache_size"] // _CACHE_SHARDS))
+    
+    @staticmethod
+    def _message_row(message: Dict) -> tuple:
+        """将消息转换为 messages 表的插入行"""
+        return (
+            message["user_id"],
+            message["user_name"],
+            message["content"],
+            message["send_time"],
+            message["session_id"],
+            message["is_group"],
+            message["reply_to"]
+        )
+    
     def _save_message(self, message: Dict):
-        """保存有效消息到数据库"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+        """将有效消息加入写入队列，由后台线程批量保存到数据库"""
+        user_id = message["user_id"]
+        
+        with self.counts_lock:
+            self._pending_messages.append(self._message_row(message))
             
-            cursor.execute('''
+            # 计数已加载时同步累加；未加载时由首次加载从数据库统计
+            if self._user_valid_counts is not None:
+                self._user_valid_counts[user_id] = self._user_valid_counts.get(user_id, 0) + 1
+        
+        if len(self._pending_messages) >= _FLUSH_THRESHOLD:
+            self._flush_event.set()
+    
+    def _flush_messages(self):
+        """将写入队列中的消息批量写入数据库"""
+        dropped = []
+        with self._flush_lock:
+            # 计数已加载时，队列中的消息入队时都已计数（加载前会先写完队列），丢弃时需要扣除
+            counted = self._user_valid_counts is not None
+            while self._pending_messages:
+                rows = []
+                while self._pending_messages and len(rows) < _WRITE_BATCH_SIZE:
+                    rows.append(self._pending_messages.popleft())
+                
+                try:
+                    self._write_messages(rows)
+                except Exception:
+                    # 整批写入失败时逐条重试，只丢弃本身无法写入的消息
+                    logger.exception("批量保存消息失败，改为逐条保存")
+                    dropped.extend(self._write_messages_one_by_one(rows))
+        
+        # 在 _flush_lock 外扣除计数，避免与持有 counts_lock 再写入队列的计数加载形成锁顺序反转
+        if dropped and counted:
+            with self.counts_lock:
+                for user_id, count in collections.Counter(row[0] for row in dropped).items():
+                    self._user_valid_counts[user_id] -= count
+    
+    def _write_messages_one_by_one(self, rows: List[tuple]) -> List[tuple]:
+        """逐条写入消息行，返回写入失败而被丢弃的行"""
+        dropped = []
+        for row in rows:
+            try:
+                self._write_messages([row])
+            except Exception:
+                logger.exception("保存消息失败")
+                dropped.append(row)
+        return dropped
+    
+    def _write_messages(self, rows: List[tuple]):
+        """在一个事务中写入一批消息行（调用方负责处理异常）"""
+        with self._transaction() as conn:
+            conn.executemany('''
                 INSERT INTO messages (user_id, user_name, content, send_time, session_id, is_group, reply_to)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                message["user_id"],
-                message["user_name"],
-                message["content"],
-                message["send_time"],
-                message["session_id"],
-                message["is_group"],
-                message["reply_to"]
-            ))
-            
-            conn.commit()
-            conn.close()
-            
-            # 更新统计
-            self._update_statistic("total_messages", 1)
-            self._update_statistic("valid_messages", 1)
-            
-        except Exception as e:
-            print(f"[{self.name}] 保存消息失败: {e}")
+            ''', rows)
+        
+        # 更新统计
+        self._increment_statistic("total_messages", len(rows))
+        self._increment_statistic("valid_messages", len(rows))
+    
+    def _save_messages(self, rows: List[tuple]):
+        """绕过写入队列直接批量保存消息行（用于导入等批量场景）"""
+        # 写事务期间不持有 counts_lock，避免阻塞实时消息入队；
+        # 与计数加载共用 _flush_lock 串行执行，由写入序号判断加载结果是否已包含本批
+        with self._flush_lock:
+            self._write_messages(rows)
+            self._bulk_write_seq += 1
+            seq = self._bulk_write_seq
+        
+        # 计数在本批提交之前就已加载时才累加，避免与加载结果重复统计
+        with self.counts_lock:
+            if self._user_valid_counts is not None and seq > self._counts_write_seq:
+                for user_id, count in collections.Counter(row[0] for row in rows).items():
+                    self._user_valid_counts[user_id] = self._user_valid_counts.get(user_id, 0) + count
+    
+    def _flush_loop(self):
+        """后台写入线程"""
+        while not self._stop_event.is_set():
+            self._flush_event.wait(_FLUSH_INTERVAL)
+            self._flush_event.clear()
+            self._flush_messages()
+            self._flush_statistics()
+            self._sweep_caches()
+    
+    def _sweep_caches(self):
+        """淘汰去重缓存中的过期项（由后台线程定期调用，空闲时也能释放内存）"""
+        current_time = time.time()
+        for shard in self._cache_shards:
+            with shard.lock:
+                shard.cache.expire(current_time)
+        with self.import_cache_lock:
+            self.import_cache.expire(current_time)
+    
+    def _start_flush_thread(self):
+        """启动后台写入线程（已在运行时不重复启动）"""
+        if self._flush_thread and self._flush_thread.is_alive():
+            return
+        
+        self._stop_event.clear()
+        self._flush_thread = threading.Thread(target=self._flush_loop)
+        self._flush_thread.daemon = True
+        self._flush_thread.start()
     
     # 二、核心：多维度风格分析模块
     def _analyze_style(self, user_id: str, messages: List[Dict]) -> Dict:
@@ -327,10 +798,13 @@ class StyleLearningPlugin:
         if not messages:
             return {}
         
+        # 词表只扫描一遍，供语言风格和情感风格共用
+        lexicon_hits = self._scan_lexicon(messages)
+        
         style = {
             "user_id": user_id,
-            "language_style": self._analyze_language_style(messages),
-            "emotional_style": self._analyze_emotional_style(messages),
+            "language_style": self._analyze_language_style(messages, lexicon_hits),
+            "emotional_style": self._analyze_emotional_style(messages, lexicon_hits),
             "conversation_style": self._analyze_conversation_style(messages),
             "scene_patterns": self._extract_scene_patterns(messages),
             "update_time": int(time.time())
@@ -338,45 +812,37 @@ class StyleLearningPlugin:
         
         return style
     
-    def _analyze_language_style(self, messages: List[Dict]) -> Dict:
+    def _scan_lexicon(self, messages: List[Dict]) -> Dict[str, List[bool]]:
+        """扫描每条消息是否命中各词表类别（按类别返回逐条消息的命中标记）"""
+        contents = list(map(operator.itemgetter("content"), messages))
+        return {
+            category: list(map(bool, map(pattern.search, contents)))
+            for category, pattern in _LEXICON_PATTERNS
+        }
+    
+    def _analyze_language_style(self, messages: List[Dict], lexicon_hits: Optional[Dict[str, List[bool]]] = None) -> Dict:
         """分析语言风格"""
-        # 统计各种语言特征
-        total_length = 0
-        exclamation_count = 0
-        question_count = 0
-        emoji_count = 0
-        sentence_count = 0
+        if lexicon_hits is None:
+            lexicon_hits = self._scan_lexicon(messages)
         
-        for msg in messages:
-            content = msg["content"]
-            total_length += len(content)
-            sentence_count += len(re.split(r'[。！？!?.]', content))
-            exclamation_count += content.count('!') + content.count('！')
-            question_count += content.count('?') + content.count('？')
-            # 安全的表情符号匹配方式（避免Unicode转义问题）
-            emoji_pattern = re.compile(r'[\U0001F600-\U0001F6FF]', re.UNICODE)
-            emoji_count += len(emoji_pattern.findall(content))
+        # 统计各种语言特征（拼接后整体计数，换行符不属于任何被统计的字符）
+        contents = list(map(operator.itemgetter("content"), messages))
+        all_text = "\n".join(contents)
+        
+        total_length = sum(map(len, contents))
+        # 每条消息按分隔符切分的段数 = 分隔符数 + 1
+        sentence_count = len(_SENT_SPLIT_RE.findall(all_text)) + len(contents)
+        exclamation_count = all_text.count('!') + all_text.count('！')
+        question_count = all_text.count('?') + all_text.count('？')
+        emoji_count = len(_EMOJI_RE.findall(all_text))
         
         # 计算平均值
         avg_length = total_length / len(messages) if messages else 0
         avg_sentence_length = total_length / sentence_count if sentence_count else 0
         
         # 分析正式度
-        formal_words = ["您好", "请问", "谢谢", "对不起", "请"]
-        informal_words = ["哈哈", "嘿嘿", "哦哦", "嗯", "哎"]
-        
-        formal_count = 0
-        informal_count = 0
-        
-        for msg in messages:
-            for word in formal_words:
-                if word in msg["content"]:
-                    formal_count += 1
-                    break
-            for word in informal_words:
-                if word in msg["content"]:
-                    informal_count += 1
-                    break
+        formal_count = sum(lexicon_hits["formal"])
+        informal_count = sum(lexicon_hits["informal"])
         
         # 确定正式度
         formal_degree = 0.5
@@ -394,31 +860,20 @@ class StyleLearningPlugin:
             "emoji_frequency": emoji_count / len(messages) if messages else 0
         }
     
-    def _analyze_emotional_style(self, messages: List[Dict]) -> Dict:
+    def _analyze_emotional_style(self, messages: List[Dict], lexicon_hits: Optional[Dict[str, List[bool]]] = None) -> Dict:
         """分析情感风格"""
-        # 简单的情感分析
-        positive_words = ["好", "开心", "快乐", "喜欢", "不错", "棒", "优秀"]
-        negative_words = ["不好", "难过", "伤心", "讨厌", "糟糕", "差", "失望"]
+        if lexicon_hits is None:
+            lexicon_hits = self._scan_lexicon(messages)
         
-        positive_count = 0
-        negative_count = 0
-        neutral_count = 0
-        
-        for msg in messages:
-            content = msg["content"]
-            has_positive = any(word in content for word in positive_words)
-            has_negative = any(word in content for word in negative_words)
-            
-            if has_positive and has_negative:
-                neutral_count += 1
-            elif has_positive:
-                positive_count += 1
-            elif has_negative:
-                negative_count += 1
-            else:
-                neutral_count += 1
+        # 简单的情感分析：同时命中正负面词或都未命中的消息视为中性
+        positive_hits = lexicon_hits["positive"]
+        negative_hits = lexicon_hits["negative"]
+        both_count = sum(map(operator.and_, positive_hits, negative_hits))
         
         total = len(messages)
+        positive_count = sum(positive_hits) - both_count
+        negative_count = sum(negative_hits) - both_count
+        neutral_count = total - positive_count - negative_count
         return {
             "positive_ratio": positive_count / total if total else 0,
             "negative_ratio": negative_count / total if total else 0,
@@ -428,19 +883,11 @@ class StyleLearningPlugin:
     
     def _analyze_conversation_style(self, messages: List[Dict]) -> Dict:
         """分析对话结构风格"""
-        reply_count = 0
-        question_count = 0
-        statement_count = 0
+        reply_count = len(messages) - list(map(operator.itemgetter("reply_to"), messages)).count(None)
         
-        for msg in messages:
-            if msg["reply_to"] is not None:
-                reply_count += 1
-            
-            content = msg["content"]
-            if content.endswith(('?', '？')):
-                question_count += 1
-            else:
-                statement_count += 1
+        question_marks = ('?', '？')
+        question_count = sum(msg["content"].endswith(question_marks) for msg in messages)
+        statement_count = len(messages) - question_count
         
         return {
             "reply_ratio": reply_count / len(messages) if messages else 0,
@@ -457,7 +904,7 @@ class StyleLearningPlugin:
             content = msg["content"]
             
             # 问候场景
-            if re.search(r'(你好|您好|早上好|晚上好|hello|hi)', content, re.IGNORECASE):
+            if _GREETING_RE.search(content):
                 patterns.append({
                     "scene": "greeting",
                     "expression": content,
@@ -465,7 +912,7 @@ class StyleLearningPlugin:
                 })
             
             # 求助场景
-            elif re.search(r'(帮我|求助|需要|怎么|如何)', content):
+            elif _HELP_RE.search(content):
                 patterns.append({
                     "scene": "request_help",
                     "expression": content,
@@ -473,7 +920,7 @@ class StyleLearningPlugin:
                 })
             
             # 感谢场景
-            elif re.search(r'(谢谢|感谢|谢了|麻烦了)', content):
+            elif _THANKS_RE.search(content):
                 patterns.append({
                     "scene": "thanks",
                     "expression": content,
@@ -483,47 +930,79 @@ class StyleLearningPlugin:
         return patterns
     
     # 三、核心：灵活的学习模式模块
+    def _start_executor(self):
+        """创建学习任务线程池（已存在时不重复创建）"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=_LEARNING_WORKERS,
+                thread_name_prefix=self.name
+            )
+    
     def _trigger_learning(self, message: Dict):
         """触发学习任务"""
         user_id = message["user_id"]
         session_id = message["session_id"]
         
         # 检查是否需要启动学习任务
+        future = None
         with self.tasks_lock:
+            if self.executor is None:
+                return
+            
             if session_id not in self.learning_tasks or not self.learning_tasks[session_id]:
                 # 获取用户的有效消息数量
                 valid_count = self._get_valid_message_count(user_id)
                 
                 if valid_count >= self.config["learning"]["batch_size"]:
-                    # 启动异步学习任务
-                    task = threading.Thread(
-                        target=self._batch_learning,
-                        args=(user_id, session_id)
-                    )
-                    task.daemon = True
-                    task.start()
+                    # 提交异步学习任务
+                    future = self.executor.submit(self._batch_learning, user_id, session_id)
                     
-                    self.learning_tasks[session_id] = task
-                    print(f"[{self.name}] 启动学习任务: 用户 {user_id}, 会话 {session_id}")
+                    self.learning_tasks[session_id] = future
+                    self._active_tasks += 1
+                    logger.debug("启动学习任务: 用户 %s, 会话 %s", user_id, session_id)
+        
+        # 任务结束（包括被取消）时减少计数；回调可能立即在当前线程执行，因此在锁外注册
+        if future is not None:
+            future.add_done_callback(self._on_learning_task_done)
+    
+    def _on_learning_task_done(self, future):
+        """学习任务结束回调"""
+        with self.tasks_lock:
+            self._active_tasks -= 1
     
     def _get_valid_message_count(self, user_id: str) -> int:
         """获取用户的有效消息数量"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT COUNT(*) FROM messages 
-                WHERE user_id = ? AND is_valid = TRUE
-            ''', (user_id,))
-            
-            count = cursor.fetchone()[0]
-            conn.close()
+        with self.counts_lock:
+            if self._user_valid_counts is None:
+                self._user_valid_counts = self._load_valid_message_counts()
+                if self._user_valid_counts is None:
+                    return 0
             
-            return count
-        except Exception as e:
-            print(f"[{self.name}] 获取消息数量失败: {e}")
-            return 0
+            return self._user_valid_counts.get(user_id, 0)
+    
+    def _load_valid_message_counts(self) -> Optional[Dict[str, int]]:
+        """从数据库统计所有用户的有效消息数量（调用方需持有 counts_lock）"""
+        try:
+            # 持有 _flush_lock 期间不会有批量写入提交，记录统计结果已包含的写入序号
+            with self._flush_lock:
+                # 先写入队列中的消息，保证统计结果包含全部已接收消息
+                self._flush_messages()
+                
+                conn = self._connect()
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    SELECT user_id, COUNT(*) FROM messages
+                    WHERE is_valid = TRUE
+                    GROUP BY user_id
+                ''')
+                
+                counts = dict(cursor.fetchall())
+                self._counts_write_seq = self._bulk_write_seq
+                return counts
+        except Exception:
+            logger.exception("获取消息数量失败")
+            return None
     
     def _batch_learning(self, user_id: str, session_id: str):
         """批量学习任务"""
@@ -531,7 +1010,8 @@ class StyleLearningPlugin:
             # 获取用户的有效消息
             messages = self._get_user_messages(user_id, limit=self.config["learning"]["batch_size"])
             
-            if not messages:
+            # 插件正在卸载时不再开始分析
+            if not messages or self._stop_event.is_set():
                 return
             
             # 分析风格特征
@@ -541,13 +1021,13 @@ class StyleLearningPlugin:
             self._save_style_features(user_id, style)
             
             # 更新学习统计
-            self._update_statistic("style_updates", 1)
+            self._increment_statistic("style_updates")
             self._update_statistic("last_learning_time", int(time.time()))
             
-            print(f"[{self.name}] 学习完成: 用户 {user_id}, 分析了 {len(messages)} 条消息")
+            logger.info("学习完成: 用户 %s, 分析了 %d 条消息", user_id, len(messages))
             
-        except Exception as e:
-            print(f"[{self.name}] 学习任务失败: {e}")
+        except Exception:
+            logger.exception("学习任务失败")
         finally:
             # 清除任务标记
             with self.tasks_lock:
@@ -556,8 +1036,10 @@ class StyleLearningPlugin:
     
     def _get_user_messages(self, user_id: str, limit: int = 100) -> List[Dict]:
         """获取用户的消息"""
+        self._flush_messages()
+        
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -569,7 +1051,6 @@ class StyleLearningPlugin:
             ''', (user_id, limit))
             
             rows = cursor.fetchall()
-            conn.close()
             
             messages = []
             for row in rows:
@@ -585,51 +1066,48 @@ class StyleLearningPlugin:
                 })
             
             return messages
-        except Exception as e:
-            print(f"[{self.name}] 获取用户消息失败: {e}")
+        except Exception:
+            logger.exception("获取用户消息失败")
             return []
     
     def _save_style_features(self, user_id: str, style: Dict):
         """保存风格特征到数据库"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             update_time = int(time.time())
             
-            # 保存语言风格
-            for feature, value in style["language_style"].items():
-                cursor.execute('''
-                    INSERT OR REPLACE INTO style_features 
-                    (user_id, feature_name, feature_value, confidence, update_time)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, f"language_{feature}", str(value), 0.8, update_time))
-            
-            # 保存情感风格
-            for feature, value in style["emotional_style"].items():
-                cursor.execute('''
-                    INSERT OR REPLACE INTO style_features 
-                    (user_id, feature_name, feature_value, confidence, update_time)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, f"emotion_{feature}", str(value), 0.7, update_time))
+            # 语言风格、情感风格、对话风格的数值特征行
+            rows = [
+                (user_id, f"language_{feature}", value, None, 0.8, update_time)
+                for feature, value in style["language_style"].items()
+            ] + [
+                (user_id, f"emotion_{feature}", value, None, 0.7, update_time)
+                for feature, value in style["emotional_style"].items()
+            ] + [
+                (user_id, f"conversation_{feature}", value, None, 0.8, update_time)
+                for feature, value in style["conversation_style"].items()
+            ]
             
-            # 保存对话风格
-            for feature, value in style["conversation_style"].items():
-                cursor.execute('''
-                    INSERT OR REPLACE INTO style_features 
-                    (user_id, feature_name, feature_value, confidence, update_time)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, f"conversation_{feature}", str(value), 0.8, update_time))
+            # 场景模式以 JSON 文本保存
+            rows.append((
+                user_id, "scene_patterns", None,
+                _JSON_ENCODER.encode(style["scene_patterns"]), 0.8, update_time
+            ))
             
-            conn.commit()
-            conn.close()
+            with self._transaction() as conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO style_features
+                    (user_id, feature_name, feature_value, feature_text, confidence, update_time)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', rows)
             
             # 更新内存中的风格特征
             with self.style_lock:
-                self.style_features[user_id] = style
+                style_features = dict(self.style_features)
+                style_features[user_id] = style
+                self.style_features = style_features
                 
-        except Exception as e:
-            print(f"[{self.name}] 保存风格特征失败: {e}")
+        except Exception:
+            logger.exception("保存风格特征失败")
     
     # 四、关键：学习结果落地应用模块
     def get_style_prompt(self, user_id: str, session_id: str, context: List[Dict]) -> str:
@@ -677,57 +1155,74 @@ class StyleLearningPlugin:
     
     def _get_user_style(self, user_id: str) -> Optional[Dict]:
         """获取用户的风格特征"""
-        # 先从内存中获取
-        with self.style_lock:
-            if user_id in self.style_features:
-                return self.style_features[user_id]
+        return self._get_user_styles([user_id]).get(user_id)
+    
+    def _get_user_styles(self, user_ids: List[str]) -> Dict[str, Dict]:
+        """批量获取多个用户的风格特征（没有风格特征的用户不会出现在结果中）"""
+        styles = {}
+        missing = []
         
-        # 从数据库中获取
+        # 先从内存快照中获取
+        style_features = self.style_features
+        for user_id in dict.fromkeys(user_ids):
+            style = style_features.get(user_id)
+            if style is not None:
+                styles[user_id] = style
+            else:
+                missing.append(user_id)
+        
+        if not missing:
+            return styles
+        
+        # 从数据库中按块获取，避免超出 SQLite 的参数个数上限
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT feature_name, feature_value, confidence 
-                FROM style_features 
-                WHERE user_id = ?
-            ''', (user_id,))
-            
-            rows = cursor.fetchall()
-            conn.close()
-            
-            if not rows:
-                return None
-            
-            # 重构风格特征
-            style = {
-                "user_id": user_id,
-                "language_style": {},
-                "emotional_style": {},
-                "conversation_style": {},
-                "scene_patterns": [],
-                "update_time": int(time.time())
-            }
+            conn = self._connect()
+            update_time = int(time.time())
+            loaded = {}
             
-            for row in rows:
-                feature_name, feature_value, confidence = row
+            for i in range(0, len(missing), _STYLE_QUERY_CHUNK):
+                chunk = missing[i:i + _STYLE_QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(f'''
+                    SELECT user_id, feature_name, feature_value, feature_text
+                    FROM style_features
+                    WHERE user_id IN ({placeholders})
+                ''', chunk).fetchall()
                 
-                if feature_name.startswith("language_"):
-                    style["language_style"][feature_name[9:]] = float(feature_value)
-                elif feature_name.startswith("emotion_"):
-                    style["emotional_style"][feature_name[8:]] = float(feature_value)
-                elif feature_name.startswith("conversation_"):
-                    style["conversation_style"][feature_name[13:]] = float(feature_value)
-            
-            # 保存到内存
-            with self.style_lock:
-                self.style_features[user_id] = style
-            
-            return style
+                # 重构风格特征
+                for user_id, feature_name, feature_value, feature_text in rows:
+                    style = loaded.get(user_id)
+                    if style is None:
+                        style = loaded[user_id] = {
+                            "user_id": user_id,
+                            "language_style": {},
+                            "emotional_style": {},
+                            "conversation_style": {},
+                            "scene_patterns": [],
+                            "update_time": update_time
+                        }
+                    
+                    if feature_name.startswith("language_"):
+                        style["language_style"][feature_name[9:]] = feature_value
+                    elif feature_name.startswith("emotion_"):
+                        style["emotional_style"][feature_name[8:]] = feature_value
+                    elif feature_name.startswith("conversation_"):
+                        style["conversation_style"][feature_name[13:]] = feature_value
+                    elif feature_name == "scene_patterns" and feature_text:
+                        style["scene_patterns"] = json.loads(feature_text)
             
-        except Exception as e:
-            print(f"[{self.name}] 获取风格特征失败: {e}")
-            return None
+            # 保存到内存（期间已有其他线程写入的以内存中的为准）
+            if loaded:
+                with self.style_lock:
+                    style_features = dict(self.style_features)
+                    for user_id, style in loaded.items():
+                        styles[user_id] = style_features.setdefault(user_id, style)
+                    self.style_features = style_features
+                    
+        except Exception:
+            logger.exception("获取风格特征失败")
+        
+        return styles
     
     # 五、管理：风格与人格管控模块
     def update_style_config(self, user_id: str, config: Dict):
@@ -749,10 +1244,10 @@ class StyleLearningPlugin:
     def update_session_context(self, session_id: str, context: List[Dict]):
         """更新会话上下文"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
-            context_data = json.dumps(context)
+            context_data = _JSON_ENCODER.encode(context)
             update_time = int(time.time())
             
             cursor.execute('''
@@ -761,16 +1256,13 @@ class StyleLearningPlugin:
                 VALUES (?, ?, ?)
             ''', (session_id, context_data, update_time))
             
-            conn.commit()
-            conn.close()
-            
-        except Exception as e:
-            print(f"[{self.name}] 更新会话上下文失败: {e}")
+        except Exception:
+            logger.exception("更新会话上下文失败")
     
     def get_session_context(self, session_id: str) -> List[Dict]:
         """获取会话上下文"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -779,22 +1271,21 @@ class StyleLearningPlugin:
             ''', (session_id,))
             
             row = cursor.fetchone()
-            conn.close()
             
             if row:
                 return json.loads(row[0])
             
             return []
             
-        except Exception as e:
-            print(f"[{self.name}] 获取会话上下文失败: {e}")
+        except Exception:
+            logger.exception("获取会话上下文失败")
             return []
     
     # 七、保障：数据管理与统计模块
     def _update_statistic(self, metric_name: str, metric_value: Any):
         """更新统计数据"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             update_time = int(time.time())
@@ -805,21 +1296,51 @@ class StyleLearningPlugin:
                 VALUES (?, ?, ?)
             ''', (metric_name, str(metric_value), update_time))
             
-            conn.commit()
-            conn.close()
-            
-        except Exception as e:
-            print(f"[{self.name}] 更新统计数据失败: {e}")
+        except Exception:
+            logger.exception("更新统计数据失败")
+    
+    def _increment_statistic(self, metric_name: str, delta: int = 1):
+        """累加计数类统计（仅更新内存，由后台线程批量写入数据库）"""
+        with self.stats_lock:
+            self._stat_counters[metric_name] += delta
+    
+    def _flush_statistics(self):
+        """将内存中累积的计数增量写入数据库"""
+        with self.stats_lock:
+            if not self._stat_counters:
+                return
+            deltas = self._stat_counters
+            self._stat_counters = collections.defaultdict(int)
+        
+        try:
+            update_time = int(time.time())
+            with self._transaction() as conn:
+                conn.executemany('''
+                    INSERT INTO statistics (metric_name, metric_value, update_time)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(metric_name) DO UPDATE SET
+                        metric_value = CAST(CAST(metric_value AS INTEGER) + excluded.metric_value AS TEXT),
+                        update_time = excluded.update_time
+                ''', [(name, delta, update_time) for name, delta in deltas.items()])
+                
+        except Exception:
+            logger.exception("更新统计数据失败")
+            # 写入失败时放回增量，下次重试
+            with self.stats_lock:
+                for name, delta in deltas.items():
+                    self._stat_counters[name] += delta
     
     def get_statistics(self) -> Dict:
         """获取统计数据"""
+        self._flush_messages()
+        self._flush_statistics()
+        
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             cursor.execute('SELECT metric_name, metric_value, update_time FROM statistics')
             rows = cursor.fetchall()
-            conn.close()
             
             statistics = {}
             for row in rows:
@@ -831,8 +1352,8 @@ class StyleLearningPlugin:
             
             return statistics
             
-        except Exception as e:
-            print(f"[{self.name}] 获取统计数据失败: {e}")
+        except Exception:
+            logger.exception("获取统计数据失败")
             return {}
     
     def export_data(self, user_id: Optional[str] = None, format: str = "json") -> str:
@@ -868,27 +1389,46 @@ class StyleLearningPlugin:
         }
         
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                result["total_lines"] = len(lines)
+            with self._import_writer(result) as (write_queue, write_errors), \
+                 open(file_path, 'r', encoding='utf-8', buffering=_IMPORT_READ_BUFFER) as f:
+                self._advise_sequential(f)
+                
+                # 先数一遍行数（用于生成相对时间戳和输出进度），再逐行流式处理
+                total_lines = self._count_lines(f)
+                result["total_lines"] = total_lines
+                
+                # 没有时间戳的行按行号生成相对时间（每行间隔1分钟，最后一行为当前时间），只需取一次当前时间
+                base_time = int(time.time()) - total_lines * 60
+                
+                # 通过过滤的消息，每攒够一批统一去重并写入数据库
+                pending = []
+                # 实际导入的消息，导入完成后直接用于风格分析
+                imported = []
                 
                 # 处理每条记录
-                for i, line in enumerate(lines):
+                for i, line in enumerate(f):
+                    # 空行与分隔线不是消息，在解析时间戳和去重之前直接计为过滤
                     line = line.strip()
-                    if not line:
+                    if not line or _SEPARATOR_RE.fullmatch(line):
+                        result["filtered_lines"] += 1
                         continue
                     
                     # 尝试解析时间戳（支持常见格式如：[2023-10-05 14:30:00] 或 2023/10/05 14:30:00）
-                    timestamp_match = re.search(r'^\[?(\d{4}[-/]\d{2}[-/]\d{2}\s\d{2}:\d{2}:\d{2})\]?', line)
+                    timestamp = None
+                    timestamp_match = _TIMESTAMP_RE.match(line)
                     if timestamp_match:
-                        # 解析到时间戳，使用真实时间
-                        timestamp = int(datetime.datetime.strptime(timestamp_match.group(1), '%Y-%m-%d %H:%M:%S').timestamp())
-                    else:
+                        # 解析到时间戳，使用真实时间（日期不合法时按无时间戳处理）
+                        try:
+                            timestamp = int(datetime.datetime(*map(int, timestamp_match.groups())).timestamp())
+                        except ValueError:
+                            pass
+                    
+                    if timestamp is None:
                         # 简单的时间戳生成（使用文件行号作为相对时间）
-                        timestamp = int(time.time()) - (len(lines) - i) * 60  # 每条消息间隔1分钟
+                        timestamp = base_time + i * 60
                     
-                    # 创建消息对象
-                    message = {
+                    # 直接按元数据结构创建消息（字段齐全，无需再经过格式验证和元数据提取生成第二个字典）
+                    message_data = {
                         "user_id": user_id,
                         "user_name": user_name,
                         "content": line,
@@ -899,89 +1439,226 @@ class StyleLearningPlugin:
                     }
                     
                     try:
-                        # 验证消息格式
-                        if not self._is_valid_message_format(message):
-                            result["error_lines"] += 1
-                            continue
-                        
-                        # 提取元数据
-                        message_data = self._extract_message_metadata(message)
-                        
                         # 过滤消息
                         if not self._filter_message(message_data):
                             result["filtered_lines"] += 1
                             continue
                         
-                        # 检查重复（使用特殊的导入缓存，避免与实时消息冲突）
-                        import_cache_key = f"import:{session_id}:{hashlib.md5(line.encode('utf-8')).hexdigest()}"
-                        with self.cache_lock:
-                            if import_cache_key in self.message_cache:
-                                result["duplicate_lines"] += 1
-                                continue
-                            else:
-                                self.message_cache[import_cache_key] = {
-                                    "timestamp": time.time(),
-                                    "count": 1
-                                }
+                        # 加入待处理批次
+                        pending.append(message_data)
                         
-                        # 保存消息
-                        self._save_message(message_data)
-                        result["imported_lines"] += 1
-                        
-                        # 每100条消息输出进度
-                        if (i + 1) % 100 == 0:
-                            print(f"[{self.name}] 导入进度: {i+1}/{len(lines)} 行")
-                            
                     except Exception as e:
                         result["error_lines"] += 1
-                        print(f"[{self.name}] 导入第 {i+1} 行失败: {e}")
+                        logger.warning("导入第 %d 行失败: %s", i + 1, e)
+                        continue
+                    
+                    # 攒够一批后交给写入线程（写入线程出错时在此抛出，终止整个导入）
+                    if len(pending) >= _WRITE_BATCH_SIZE:
+                        imported.extend(self._import_batch(pending, session_id, result, write_queue, write_errors))
+                        pending = []
+                    
+                    # 定期输出进度
+                    if (i + 1) % _IMPORT_PROGRESS_INTERVAL == 0:
+                        logger.debug("导入进度: %d/%d 行", i + 1, total_lines)
+                
+                # 处理最后一批
+                if pending:
+                    imported.extend(self._import_batch(pending, session_id, result, write_queue, write_errors))
             
             # 导入完成后触发批量学习
             if result["imported_lines"] > 0:
-                print(f"[{self.name}] 导入完成，开始批量学习...")
+                logger.info("导入完成，开始批量学习...")
                 
                 try:
-                    # 获取导入的消息
-                    messages = self._get_user_messages(user_id, limit=result["imported_lines"])
-                    if messages:
-                        # 分析风格
-                        style = self._analyze_style(user_id, messages)
-                        # 保存风格特征
-                        self._save_style_features(user_id, style)
+                    # 直接使用内存中刚导入的消息，无需再从数据库查回
+                    # （按发送时间从新到旧排列，与数据库查询的顺序一致）
+                    imported.sort(key=operator.itemgetter("send_time"), reverse=True)
+                    # 分析风格
+                    style = self._analyze_style(user_id, imported)
+                    # 保存风格特征
+                    self._save_style_features(user_id, style)
                     
-                    print(f"[{self.name}] 批量学习完成")
-                except Exception as e:
-                    print(f"[{self.name}] 批量学习失败: {str(e)}")
+                    logger.info("批量学习完成")
+                except Exception:
+                    logger.exception("批量学习失败")
             
             # 更新结束时间（使用浮点数，与start_time保持一致）
             result["end_time"] = time.time()
-            print(f"[{self.name}] 聊天记录导入完成: {result}")
+            logger.info("聊天记录导入完成: %s", result)
             
-        except Exception as e:
-            print(f"[{self.name}] 导入聊天记录失败: {str(e)}")
-            result["error_lines"] += result["total_lines"] - result["imported_lines"] - result["filtered_lines"] - result["duplicate_lines"]
+        except Exception:
+            logger.exception("导入聊天记录失败")
+            # 未导入、未被过滤且不重复的行（含已逐行计入的错误行）都计为错误
+            result["error_lines"] = result["total_lines"] - result["imported_lines"] - result["filtered_lines"] - result["duplicate_lines"]
         
         return result
     
+    @staticmethod
+    def _advise_sequential(f):
+        """提示内核将顺序读取整个文件，加大预读，使磁盘读取与解析重叠进行（平台不支持时忽略）"""
+        if not hasattr(os, "posix_fadvise"):
+            return
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+    
+    @staticmethod
+    def _count_lines(f) -> int:
+        """统计文件行数：内存映射后直接按字节分块数行尾，无需逐行解码
+        
+        与文本模式逐行读取使用相同的通用换行规则：\\n、\\r\\n 和单独的 \\r 都算一个行尾。
+        """
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return 0
+        
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            count = 0
+            for start in range(0, size, _LINE_COUNT_CHUNK):
+                end = start + _LINE_COUNT_CHUNK
+                chunk = mm[start:end]
+                count += chunk.count(b'\n') + chunk.count(b'\r') - chunk.count(b'\r\n')
+                # \r\n 被分块边界切开时，上面按两个行尾计算了
+                if chunk.endswith(b'\r') and mm[end:end + 1] == b'\n':
+                    count -= 1
+            # 最后一行没有行尾时也算一行
+            if mm[size - 1:size] not in (b'\n', b'\r'):
+                count += 1
+        
+        return count
+    
+    def _import_batch(self, pending: List[Dict], session_id: str, result: Dict,
+                      write_queue: queue.Queue, write_errors: List[Exception]) -> List[Dict]:
+        """对一批导入消息去重，并把需要写入的行交给写入线程，返回去重后实际导入的消息
+        
+        写入线程已出错时直接抛出该错误，停止继续解析文件。
+        """
+        if write_errors:
+            raise write_errors[0]
+        
+        # 在锁外集中计算整批消息的去重键 (会话ID, 内容哈希)
+        # 导入缓存只在进程内使用，与实时消息一样直接用内置的 64 位字符串哈希，无需编码和摘要
+        keys = [(session_id, hash(message["content"])) for message in pending]
+        
+        candidate_rows = list(map(self._message_row, pending))
+        
+        # 整批只加一次锁完成去重检查；导入缓存有独立的锁，不会阻塞实时消息的去重
+        # （未在前面加布隆过滤器：锁内只剩一次字典查找，纯 Python 的布隆探测反而更慢）
+        rows = []
+        accepted = []
+        accepted_keys = []
+        with self.import_cache_lock:
+            current_time = time.time()
+            cache = self.import_cache
+            cache.expire(current_time)
+            for key, message, row in zip(keys, pending, candidate_rows):
+                if key in cache:
+                    result["duplicate_lines"] += 1
+                    continue
+                cache.set(key, 1, current_time)
+                rows.append(row)
+                accepted.append(message)
+                accepted_keys.append(key)
+        
+        # 连同去重键一起交给写入线程，写入失败时由写入线程移除这些键
+        if rows:
+            write_queue.put((rows, accepted_keys))
+        return accepted
+    
+    @contextlib.contextmanager
+    def _import_writer(self, result: Dict):
+        """启动导入写入线程：解析和去重在调用线程中进行，数据库写入在后台线程中同时进行
+        
+        产出 (写入队列, 写入错误列表)；退出时发送结束标记并等待写入完成，写入出错时在调用线程中重新抛出。
+        """
+        write_queue = queue.Queue(maxsize=_IMPORT_QUEUE_SIZE)
+        errors = []
+        
+        writer = threading.Thread(
+            target=self._import_write_loop,
+            args=(write_queue, result, errors),
+            name=f"{self.name}-import-writer"
+        )
+        writer.daemon = True
+        writer.start()
+        
+        try:
+            yield write_queue, errors
+        finally:
+            write_queue.put(None)
+            writer.join()
+        
+        if errors:
+            raise errors[0]
+    
+    def _import_write_loop(self, write_queue: queue.Queue, result: Dict, errors: List[Exception]):
+        """导入写入线程：逐批写入数据库，直到收到结束标记 None
+        
+        出错后不再写入，只继续取出剩余批次（避免解析线程阻塞在队列上），
+        并从导入去重缓存中移除未写入批次的键，使这些行可以重新导入。
+        """
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            
+            rows, keys = item
+            if not errors:
+                try:
+                    self._save_messages(rows)
+                    result["imported_lines"] += len(rows)
+                    continue
+                except Exception as e:
+                    errors.append(e)
+            
+            with self.import_cache_lock:
+                for key in keys:
+                    self.import_cache.discard(key)
+    
     # 八、基础：稳定性与运维模块
     def on_plugin_unload(self):
         """插件卸载时的清理工作"""
-        # 停止所有学习任务
+        # 通知学习任务与后台写入线程停止，二者共用同一个等待期限
+        self._stop_event.set()
+        self._flush_event.set()
+        deadline = time.monotonic() + _UNLOAD_TIMEOUT
+        
+        # 停止所有学习任务：取消尚未开始的任务，在锁外同时等待正在运行的任务
+        with self.tasks_lock:
+            executor = self.executor
+            self.executor = None
+            futures = [f for f in self.learning_tasks.values() if f]
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if futures:
+            concurrent.futures.wait(futures, timeout=max(0, deadline - time.monotonic()))
         with self.tasks_lock:
-            for task in self.learning_tasks.values():
-                if task and task.is_alive():
-                    # 等待任务完成
-                    task.join(timeout=5)
+            self.learning_tasks.clear()
+        
+        # 等待后台写入线程退出并写入剩余消息
+        if self._flush_thread:
+            self._flush_thread.join(timeout=max(0, deadline - time.monotonic()))
+        self._flush_messages()
+        self._flush_statistics()
         
         # 清理内存缓存
-        with self.cache_lock:
-            self.message_cache.clear()
+        for shard in self._cache_shards:
+            with shard.lock:
+                shard.cache.clear()
+        with self.import_cache_lock:
+            self.import_cache.clear()
         
         with self.style_lock:
-            self.style_features.clear()
+            self.style_features = {}
         
         # 关闭数据库连接
-        print(f"[{self.name}] 插件卸载完成")
+        self._close_connections()
+        
+        logger.info("插件卸载完成")
+        self._stop_log_listener()
     
     def get_status(self) -> Dict:
         """获取插件状态"""
@@ -989,9 +1666,10 @@ class StyleLearningPlugin:
             "name": self.name,
             "version": self.version,
             "status": "running",
-            "message_cache_size": len(self.message_cache),
+            "message_cache_size": sum(len(shard.cache) for shard in self._cache_shards),
+            "import_cache_size": len(self.import_cache),
             "style_features_count": len(self.style_features),
-            "active_tasks": len([t for t in self.learning_tasks.values() if t and t.is_alive()]),
+            "active_tasks": self._active_tasks,
             "statistics": self.get_statistics()
         }
 
@@ -2,115 +2,125 @@
 # -*- coding: utf-8 -*-
 
 """
-AstrBot 风格学习插件测试脚本
+AstrBot 风格学习插件测试用例
+
+使用 pytest 运行（插件实例由 conftest.py 中的会话级夹具提供）：
+    python -m pytest -s test_plugin.py
+也可以直接运行本文件：
+    python test_plugin.py
 """
 
 import sys
 import os
 import time
+import sqlite3
 
-# 添加插件目录到Python路径
-sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pytest
 
-from plugin import StyleLearningPlugin
+# 风格分析与学习测试使用的消息
+TEST_MESSAGES = [
+    "今天去公园玩了，人好多啊！",
+    "哈哈，你太逗了！",
+    "是的，我也这么觉得~",
+    "明天要不要一起去看电影？",
+    "好啊好啊，我没问题！",
+    "那就这么定了，明天见！",
+    "对了，你知道附近有什么好吃的吗？",
+    "有一家新开的餐厅不错，我上周去过~",
+    "听起来不错，有空一起去尝尝",
+    "好的，下次一起去！"
+]
 
-def test_plugin():
-    """测试插件的基本功能"""
-    print("=== AstrBot 风格学习插件测试 ===")
-    
-    # 初始化插件
-    plugin = StyleLearningPlugin()
-    print("插件初始化完成")
-    
-    # 测试1：消息接收与过滤
-    print("\n1. 测试消息接收与过滤功能")
-    
-    # 测试有效消息
-    valid_message = {
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_history.txt")
+
+def _make_message(content: str) -> dict:
+    """构造测试用户的消息"""
+    return {
         "user_id": "test_user_001",
         "user_name": "测试用户",
-        "content": "你好啊，今天天气真不错！",
+        "content": content,
         "send_time": int(time.time()),
         "session_id": "test_session_001",
         "is_group": False,
         "reply_to": None
     }
+
+def test_message_filter(plugin):
+    """测试1：消息接收与过滤"""
+    print("\n1. 测试消息接收与过滤功能")
     
-    plugin.handle_message(valid_message)
+    # 测试有效消息
+    plugin.handle_message(_make_message("你好啊，今天天气真不错！"))
     print("✓ 有效消息处理完成")
     
     # 测试命令过滤
-    command_message = {
-        "user_id": "test_user_001",
-        "user_name": "测试用户",
-        "content": "!help",
-        "send_time": int(time.time()),
-        "session_id": "test_session_001",
-        "is_group": False,
-        "reply_to": None
-    }
-    
+    command_message = _make_message("!help")
+    assert not plugin._filter_message(command_message)
     plugin.handle_message(command_message)
     print("✓ 命令消息过滤完成")
     
     # 测试链接过滤
-    link_message = {
-        "user_id": "test_user_001",
-        "user_name": "测试用户",
-        "content": "这是一个测试链接：https://example.com",
-        "send_time": int(time.time()),
-        "session_id": "test_session_001",
-        "is_group": False,
-        "reply_to": None
-    }
-    
+    link_message = _make_message("这是一个测试链接：https://example.com")
+    assert not plugin._filter_message(link_message)
     plugin.handle_message(link_message)
     print("✓ 链接消息过滤完成")
+
+@pytest.mark.parametrize("content", TEST_MESSAGES)
+def test_style_learning(plugin, content):
+    """测试2：风格分析与学习（逐条添加测试消息）"""
+    message = _make_message(content)
+    assert plugin._filter_message(message)
+    plugin.handle_message(message)
+    print(f"✓ 添加测试消息 {TEST_MESSAGES.index(content) + 1}/{len(TEST_MESSAGES)}")
+
+def test_flush_drops_only_bad_message(plugin):
+    """测试2.1：写入队列中有无法保存的消息时，只丢弃该消息，同批的其他消息和计数不受影响"""
+    user_id = "flush_user_001"
+    # 先加载计数，使之后入队的消息同步累加
+    assert plugin._get_valid_message_count(user_id) == 0
     
-    # 测试2：风格分析与学习
-    print("\n2. 测试风格分析与学习功能")
-    
-    # 添加多条测试消息
-    test_messages = [
-        "今天去公园玩了，人好多啊！",
-        "哈哈，你太逗了！",
-        "是的，我也这么觉得~",
-        "明天要不要一起去看电影？",
-        "好啊好啊，我没问题！",
-        "那就这么定了，明天见！",
-        "对了，你知道附近有什么好吃的吗？",
-        "有一家新开的餐厅不错，我上周去过~",
-        "听起来不错，有空一起去尝尝",
-        "好的，下次一起去！"
-    ]
-    
-    for i, content in enumerate(test_messages):
-        message = {
-            "user_id": "test_user_001",
-            "user_name": "测试用户",
-            "content": content,
-            "send_time": int(time.time()),
-            "session_id": "test_session_001",
-            "is_group": False,
-            "reply_to": None
-        }
+    for i in range(50):
+        message = _make_message(f"写入队列测试消息{i}")
+        message["user_id"] = user_id
+        message["session_id"] = "flush_session_001"
+        if i == 25:
+            # 违反 user_name 的 NOT NULL 约束
+            message["user_name"] = None
         plugin.handle_message(message)
-        print(f"✓ 添加测试消息 {i+1}/{len(test_messages)}")
+    plugin._flush_messages()
     
-    # 测试3：获取风格提示词
+    saved = plugin._connect().execute(
+        "SELECT COUNT(*) FROM messages WHERE user_id = ?", (user_id,)
+    ).fetchone()[0]
+    assert saved == 49
+    assert plugin._get_valid_message_count(user_id) == 49
+
+def test_style_prompt(plugin):
+    """测试3：获取风格提示词（有效消息数达到 batch_size 后触发学习）"""
     print("\n3. 测试获取风格提示词功能")
     
-    prompt = plugin.get_style_prompt("test_user_001", "test_session_001", [])
-    if prompt:
-        print(f"✓ 成功获取风格提示词：")
-        print(prompt)
-    else:
-        print("✗ 未获取到风格提示词")
+    # 再发送一个批次的消息（内容各不相同，避免被去重），保证触发学习任务
+    batch_size = plugin.config["learning"]["batch_size"]
+    for i in range(batch_size):
+        plugin.handle_message(_make_message(f"{TEST_MESSAGES[i % len(TEST_MESSAGES)]}（第{i + 1}条）"))
     
-    # 测试4：获取插件状态
+    # 等待学习任务完成（任务已结束时会从 learning_tasks 中移除）
+    with plugin.tasks_lock:
+        future = plugin.learning_tasks.get("test_session_001")
+    if future is not None:
+        future.result(timeout=10)
+    
+    prompt = plugin.get_style_prompt("test_user_001", "test_session_001", [])
+    assert prompt
+    print(f"✓ 成功获取风格提示词：")
+    print(prompt)
+
+def test_status(plugin):
+    """测试4：获取插件状态"""
     print("\n4. 测试获取插件状态功能")
     
     status = plugin.get_status()
+    assert status["status"] == "running"
     print(f"✓ 插件状态：")
     for key, value in status.items():
         if isinstance(value, dict):
@@ -119,52 +129,184 @@ def test_plugin():
                 print(f"    {k}: {v}")
         else:
             print(f"  {key}: {value}")
-    
-    # 测试5：获取统计数据
+
+def test_statistics(plugin):
+    """测试5：获取统计数据"""
     print("\n5. 测试获取统计数据功能")
     
     stats = plugin.get_statistics()
+    assert isinstance(stats, dict)
     print(f"✓ 统计数据：")
     for key, value in stats.items():
         print(f"  {key}: {value}")
+
+def test_statistics_accumulate(plugin):
+    """测试5.1：消息计数按增量累加到数据库中已有的统计值上"""
+    def total_messages():
+        return int(plugin.get_statistics().get("total_messages", {}).get("value", 0))
     
-    # 测试6：历史聊天记录导入功能
+    for round_index in range(2):
+        before = total_messages()
+        for i in range(30):
+            message = _make_message(f"统计累加测试消息{round_index}-{i}")
+            message["user_id"] = "stats_user_001"
+            message["session_id"] = "stats_session_001"
+            plugin.handle_message(message)
+        assert total_messages() == before + 30
+
+@pytest.mark.skipif(not os.path.exists(HISTORY_FILE), reason="测试历史文件不存在")
+def test_import_chat_history(plugin):
+    """测试6：历史聊天记录导入"""
     print("\n6. 测试历史聊天记录导入功能")
     
-    history_file = os.path.join(os.path.dirname(__file__), "test_history.txt")
-    if os.path.exists(history_file):
-        import_result = plugin.import_chat_history(
-            file_path=history_file,
-            user_id="import_user_001",
-            user_name="导入用户",
-            session_id="import_session_001"
-        )
-        
-        print(f"✓ 聊天记录导入完成：")
-        print(f"  总行数：{import_result['total_lines']}")
-        print(f"  导入行数：{import_result['imported_lines']}")
-        print(f"  过滤行数：{import_result['filtered_lines']}")
-        print(f"  重复行数：{import_result['duplicate_lines']}")
-        print(f"  错误行数：{import_result['error_lines']}")
-        print(f"  耗时：{import_result['end_time'] - import_result['start_time']} 秒")
-        
-        # 测试导入后的风格提示词
-        print("\n7. 测试导入后的风格提示词")
-        prompt = plugin.get_style_prompt("import_user_001", "import_session_001", [])
-        if prompt:
-            print(f"✓ 成功获取导入后的风格提示词：")
-            print(prompt)
-        else:
-            print("✗ 未获取到风格提示词")
-    else:
-        print("✗ 测试历史文件不存在")
+    import_result = plugin.import_chat_history(
+        file_path=HISTORY_FILE,
+        user_id="import_user_001",
+        user_name="导入用户",
+        session_id="import_session_001"
+    )
+    
+    # 每一行都应归入且只归入一种结果
+    assert import_result["total_lines"] == (
+        import_result["imported_lines"] + import_result["filtered_lines"]
+        + import_result["duplicate_lines"] + import_result["error_lines"]
+    )
+    
+    print(f"✓ 聊天记录导入完成：")
+    print(f"  总行数：{import_result['total_lines']}")
+    print(f"  导入行数：{import_result['imported_lines']}")
+    print(f"  过滤行数：{import_result['filtered_lines']}")
+    print(f"  重复行数：{import_result['duplicate_lines']}")
+    print(f"  错误行数：{import_result['error_lines']}")
+    print(f"  耗时：{import_result['end_time'] - import_result['start_time']} 秒")
+
+def test_import_line_endings(plugin, tmp_path):
+    """测试6.1：导入使用 \\r 或 \\r\\n 换行的聊天记录，行数统计与逐行读取一致"""
+    history_file = tmp_path / "history_cr.txt"
+    history_file.write_bytes("第一条换行测试消息\r第二条换行测试消息\r\n第三条换行测试消息".encode("utf-8"))
+    
+    import_result = plugin.import_chat_history(
+        file_path=str(history_file),
+        user_id="import_user_002",
+        user_name="导入用户",
+        session_id="import_session_002"
+    )
     
-    # 清理测试数据
-    print("\n=== 测试完成 ===")
-    print("插件功能正常！")
+    assert import_result["total_lines"] == 3
+    assert import_result["imported_lines"] == 3
     
-    # 卸载插件
-    plugin.on_plugin_unload()
+    # 没有时间戳的行按行号生成的相对时间不应晚于当前时间
+    messages = plugin._get_user_messages("import_user_002")
+    assert max(message["send_time"] for message in messages) <= int(time.time())
+
+def test_import_separator_lines(plugin, tmp_path):
+    """测试6.2：导出文件中的分隔线计为过滤，用符号包围文字的普通消息照常导入"""
+    history_file = tmp_path / "history_separator.txt"
+    history_file.write_text(
+        "====== 2024-01-01 ======\n"
+        "*** 重要通知 ***\n"
+        "----------\n"
+        "### 标题 ###\n",
+        encoding="utf-8"
+    )
+    
+    import_result = plugin.import_chat_history(
+        file_path=str(history_file),
+        user_id="import_user_004",
+        user_name="导入用户",
+        session_id="import_session_004"
+    )
+    
+    assert import_result["filtered_lines"] == 2
+    assert import_result["imported_lines"] == 2
+    contents = {message["content"] for message in plugin._get_user_messages("import_user_004")}
+    assert contents == {"*** 重要通知 ***", "### 标题 ###"}
+
+def test_import_write_failure(plugin, tmp_path, monkeypatch):
+    """测试6.3：写入数据库失败时终止导入，未写入的行可以立即重新导入"""
+    history_file = tmp_path / "history_retry.txt"
+    history_file.write_text("".join(f"写入失败重试测试消息{i}\n" for i in range(1200)), encoding="utf-8")
+    
+    def failing_save(rows):
+        raise sqlite3.OperationalError("disk I/O error")
+    
+    monkeypatch.setattr(plugin, "_save_messages", failing_save)
+    import_result = plugin.import_chat_history(
+        file_path=str(history_file),
+        user_id="import_user_003",
+        user_name="导入用户",
+        session_id="import_session_003"
+    )
+    assert import_result["imported_lines"] == 0
+    assert import_result["error_lines"] == import_result["total_lines"] == 1200
+    
+    monkeypatch.undo()
+    import_result = plugin.import_chat_history(
+        file_path=str(history_file),
+        user_id="import_user_003",
+        user_name="导入用户",
+        session_id="import_session_003"
+    )
+    assert import_result["imported_lines"] == 1200
+    assert import_result["duplicate_lines"] == 0
+
+@pytest.mark.skipif(not os.path.exists(HISTORY_FILE), reason="测试历史文件不存在")
+def test_style_prompt_after_import(plugin):
+    """测试7：导入后的风格提示词"""
+    print("\n7. 测试导入后的风格提示词")
+    
+    # 导入完成后直接用导入的消息完成了风格分析
+    prompt = plugin.get_style_prompt("import_user_001", "import_session_001", [])
+    assert prompt
+    print(f"✓ 成功获取导入后的风格提示词：")
+    print(prompt)
+
+def test_migrate_style_features(tmp_path):
+    """测试8：旧版本数据库（feature_value 为 TEXT）加载时升级为 REAL 并记录 user_version"""
+    from plugin import StyleLearningPlugin
+    
+    conn = sqlite3.connect(str(tmp_path / "learning_data.db"))
+    conn.execute('''
+        CREATE TABLE style_features (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            feature_name TEXT NOT NULL,
+            feature_value TEXT NOT NULL,
+            confidence REAL NOT NULL,
+            update_time INTEGER NOT NULL,
+            UNIQUE(user_id, feature_name)
+        )
+    ''')
+    conn.executemany('''
+        INSERT INTO style_features (user_id, feature_name, feature_value, confidence, update_time)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [
+        ("migrate_user_001", "language_avg_sentence_length", "12.5", 0.8, 1700000000),
+        ("migrate_user_001", "emotion_positive_ratio", "0.3", 0.7, 1700000000),
+        ("migrate_user_001", "conversation_question_ratio", "0", 0.8, 1700000000)
+    ])
+    conn.commit()
+    conn.close()
+    
+    migrated = StyleLearningPlugin(data_path=str(tmp_path))
+    try:
+        conn = migrated._connect()
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == 1
+        columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(style_features)")}
+        assert columns["feature_value"].upper() == "REAL"
+        assert "feature_text" in columns
+        
+        rows = conn.execute('''
+            SELECT feature_name, feature_value, typeof(feature_value), confidence, update_time
+            FROM style_features WHERE user_id = ? ORDER BY id
+        ''', ("migrate_user_001",)).fetchall()
+        assert rows == [
+            ("language_avg_sentence_length", 12.5, "real", 0.8, 1700000000),
+            ("emotion_positive_ratio", 0.3, "real", 0.7, 1700000000),
+            ("conversation_question_ratio", 0.0, "real", 0.8, 1700000000)
+        ]
+    finally:
+        migrated.on_plugin_unload()
 
 if __name__ == "__main__":
-    test_plugin()
\ No newline at end of file
+    sys.exit(pytest.main([os.path.abspath(__file__), "-s", "-q"]))